@@ -1,24 +1,59 @@
 
 import json
+import os
+import time
 import boto3
 import uuid
-from datetime import datetime
-from broadcast import broadcast_message
+from boto_config import BOTO_CONFIG
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = boto3.resource('dynamodb', config=BOTO_CONFIG)
+players_table = dynamodb.Table('mcm-alerts-onesignal-players')
+comments_table = dynamodb.Table('mcm-alerts-comments')
+notifications_table = dynamodb.Table('mcm-alerts-notifications')
+
+# WebSocket fanout runs in the broadcast Lambda subscribed to this topic, so
+# API requests only pay for a single publish.
+BROADCAST_TOPIC_ARN = os.environ.get('BROADCAST_TOPIC_ARN')
+sns = boto3.client('sns', config=BOTO_CONFIG)
+
+NOTIFICATION_STATUSES = ('new', 'acknowledged', 'resolved')
+
+# Shared by every response; API Gateway only reads it, so one dict is enough.
+CORS_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type,Authorization',
+    'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS'
+}
+
+def utc_now():
+    # UTC ISO 8601 to the second, e.g. 2024-05-01T12:00:00Z.
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
 
 def get_user_from_event(event):
     return event.get('requestContext', {}).get('authorizer', {}).get('claims', {})
 
+def parse_body(event):
+    """
+    Parses the request body once into a dict. Returns None when the body is
+    not a JSON object, so handlers can answer 400 instead of failing with 500.
+    """
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+def publish_broadcast(payload):
+    try:
+        sns.publish(TopicArn=BROADCAST_TOPIC_ARN, Message=json.dumps(payload))
+    except Exception as e:
+        print(f"BROADCAST: Failed to publish {payload.get('type')}: {e}")
+
 def make_response(status_code, body):
     return {
         'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Content-Type,Authorization',
-            'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS'
-        },
+        'headers': CORS_HEADERS,
         'body': json.dumps(body)
     }
 
@@ -29,19 +64,20 @@ def register_device_handler(event, context):
         return make_response(401, {'error': 'Unauthorized'})
 
     try:
-        body = json.loads(event.get('body', '{}'))
+        body = parse_body(event)
+        if body is None:
+            return make_response(400, {'error': 'Invalid JSON body'})
         player_id = body.get('playerId')
 
         if not player_id:
             return make_response(400, {'error': 'Missing playerId'})
 
-        table = dynamodb.Table('mcm-alerts-onesignal-players')
         item = {
             'user_id': user_id,
             'player_id': player_id,
-            'created_at': datetime.utcnow().isoformat(),
+            'created_at': utc_now(),
         }
-        table.put_item(Item=item)
+        players_table.put_item(Item=item)
 
         return make_response(201, {'status': 'registered', 'playerId': player_id})
 
@@ -59,9 +95,7 @@ def unregister_device_handler(event, context):
         if not player_id:
             return make_response(400, {'error': 'Missing playerId in path'})
 
-        table = dynamodb.Table('mcm-alerts-onesignal-players')
-        
-        table.delete_item(
+        players_table.delete_item(
             Key={'user_id': user_id},
             ConditionExpression="player_id = :pid",
             ExpressionAttributeValues={":pid": player_id}
@@ -80,24 +114,25 @@ def add_comment_handler(event, context):
     if not user_id: return make_response(401, {'error': 'Unauthorized'})
 
     try:
-        body = json.loads(event.get('body', '{}'))
+        body = parse_body(event)
+        if body is None:
+            return make_response(400, {'error': 'Invalid JSON body'})
         notification_id = body.get('notification_id')
         text = body.get('text')
 
         if not notification_id or not text:
             return make_response(400, {'error': 'Missing notification_id or text'})
 
-        comments_table = dynamodb.Table('mcm-alerts-comments')
         new_comment = {
             'notification_id': notification_id,
             'id': str(uuid.uuid4()),
             'user_id': user_id,
             'text': text,
-            'created_at': datetime.utcnow().isoformat(),
+            'created_at': utc_now(),
         }
         comments_table.put_item(Item=new_comment)
 
-        broadcast_message(event, {
+        publish_broadcast({
             'type': 'NEW_COMMENT',
             'payload': new_comment
         })
@@ -116,24 +151,47 @@ def update_notification_handler(event, context):
         notification_id = event.get('pathParameters', {}).get('notification_id')
         if not notification_id: return make_response(400, {'error': 'Missing ID'})
 
-        body = json.loads(event.get('body', '{}'))
-        
-        notifications_table = dynamodb.Table('mcm-alerts-notifications')
+        body = parse_body(event)
+        if body is None:
+            return make_response(400, {'error': 'Invalid JSON body'})
+        status = body.get('status')
+        if status not in NOTIFICATION_STATUSES:
+            return make_response(400, {'error': 'Invalid or missing status'})
+
+        # Single conditional write: DynamoDB rejects the update server-side if
+        # the notification doesn't exist, so no get_item is needed first.
         response = notifications_table.update_item(
+            Key={'id': notification_id},
+            UpdateExpression="SET #s = :s, updated_at = :t",
+            ConditionExpression="attribute_exists(id)",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={
+                ":s": status,
+                ":t": utc_now(),
+            },
             ReturnValues="ALL_NEW"
         )
         updated_attributes = response.get('Attributes', {})
 
-        broadcast_message(event, {
+        publish_broadcast({
             'type': 'NOTIFICATION_UPDATED',
             'payload': updated_attributes
         })
 
         return make_response(200, updated_attributes)
 
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return make_response(404, {'error': 'Notification not found'})
     except Exception as e:
         return make_response(500, {'error': str(e)})
 
+ROUTES = {
+    ('POST', '/devices'): register_device_handler,
+    ('DELETE', '/devices/{playerId}'): unregister_device_handler,
+    ('POST', '/comments'): add_comment_handler,
+    ('PUT', '/notifications/{notification_id}'): update_notification_handler,
+}
+
 def router(event, context):
     resource = event.get('resource')
     http_method = event.get('httpMethod')
@@ -141,13 +199,8 @@ def router(event, context):
     if http_method == 'OPTIONS':
         return make_response(200, {})
 
-    if http_method == 'POST' and resource == '/devices':
-        return register_device_handler(event, context)
-    elif http_method == 'DELETE' and resource == '/devices/{playerId}':
-        return unregister_device_handler(event, context)
-    elif http_method == 'POST' and resource == '/comments':
-        return add_comment_handler(event, context)
-    elif http_method == 'PUT' and resource == '/notifications/{notification_id}':
-        return update_notification_handler(event, context)
+    handler = ROUTES.get((http_method, resource))
+    if handler:
+        return handler(event, context)
 
     return make_response(404, {'error': 'Not Found'})
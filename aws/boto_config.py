@@ -0,0 +1,15 @@
+from botocore.config import Config
+
+# Shared botocore settings for the Python Lambdas. tcp_keepalive turns on
+# SO_KEEPALIVE for the clients' sockets, so the OS sends keep-alive probes on
+# pooled connections that sit idle between warm invocations and notices the
+# ones that have dropped. botocore reuses pooled connections with or without it.
+KEEPALIVE_CONFIG = Config(tcp_keepalive=True)
+
+# Default for request handlers: adaptive retries rate-limit the client when
+# DynamoDB starts throttling, e.g. during a reconnect storm, instead of
+# retrying at full speed. Up to 10 attempts, because a dropped connect or
+# comment write is lost for good.
+BOTO_CONFIG = KEEPALIVE_CONFIG.merge(Config(
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+))
@@ -1,42 +1,299 @@
 import boto3
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+from boto_config import BOTO_CONFIG
 
-dynamodb = boto3.resource('dynamodb')
+BROADCAST_MAX_WORKERS = 32
+# Broadcasts to at most this many connections skip the thread pool.
+SERIAL_BROADCAST_LIMIT = 8
+
+# Size each client's connection pool to the fanout thread pool so workers
+# never wait on a free socket. Broadcasts run against the Lambda deadline and
+# a missed post only affects one client, so calls get 3 attempts instead of
+# the handlers' 10; a long retry chain would starve the rest of the fanout.
+BROADCAST_CONFIG = BOTO_CONFIG.merge(Config(
+    max_pool_connections=BROADCAST_MAX_WORKERS,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+))
+dynamodb = boto3.resource('dynamodb', config=BROADCAST_CONFIG)
 WEBSOCKET_CONNECTIONS_TABLE = os.environ.get('WEBSOCKET_CONNECTIONS_TABLE', 'mcm-alerts-websocket-connections')
-connections_table = dynamodb.Table(WEBSOCKET_CONNECTIONS_TABLE)
+WEBSOCKET_ENDPOINT = os.environ.get('WEBSOCKET_ENDPOINT')
+BROADCAST_QUEUE_URL = os.environ.get('BROADCAST_QUEUE_URL')
+sqs = boto3.client('sqs', config=BROADCAST_CONFIG)
+CONNECTIONS_INDEX = 'bucket-index'
+# Connection rows are spread over ACTIVE_BUCKET_SHARDS buckets by
+# connection_handler; each shard is queried in parallel.
+ACTIVE_BUCKET = 'active'
+ACTIVE_BUCKET_SHARDS = 16
+# Connections are posted to in batches so the remaining Lambda time can be
+# checked between them; the broadcast stops once less than the reserve is left.
+# The reserve covers deleting stale connections afterwards: one BatchWriteItem
+# chunk can back off for up to 0.75s across its retries.
+BROADCAST_BATCH_SIZE = 50
+BROADCAST_TIME_RESERVE_MS = 1500
+# Broadcasts to more connections than one group are split into groups that are
+# queued for the deliver Lambda. SendMessageBatch takes at most 10 messages and
+# 256 KB of message bodies per call.
+CONNECTION_GROUP_SIZE = 100
+QUEUE_BATCH_SIZE = 10
+QUEUE_BATCH_MAX_BYTES = 256 * 1024
+QUEUE_MAX_ATTEMPTS = 5
+# BatchWriteItem accepts at most 25 requests per call.
+DELETE_BATCH_SIZE = 25
+DELETE_MAX_ATTEMPTS = 5
+# Time kept free after a delete backoff for the retry call itself.
+DELETE_TIME_MARGIN_MS = 200
+
+# ApiGatewayManagementApi clients are cached per endpoint for the lifetime of
+# the Lambda container.
+_gateway_clients = {}
+
+def get_gateway_client(endpoint_url):
+    """Returns the cached ApiGatewayManagementApi client for an endpoint."""
+    gatewayapi = _gateway_clients.get(endpoint_url)
+    if gatewayapi is None:
+        gatewayapi = boto3.client("apigatewaymanagementapi", endpoint_url=endpoint_url, config=BROADCAST_CONFIG)
+        _gateway_clients[endpoint_url] = gatewayapi
+    return gatewayapi
 
-def broadcast_message(event, payload):
+def get_shard_connection_ids(shard):
     """
-    Broadcasts a payload to all connected WebSocket clients.
+    Returns the ids of all connections in one bucket shard, following
+    LastEvaluatedKey so that no page of the bucket-index is skipped.
+    """
+    connection_ids = []
+    query_kwargs = {
+        'TableName': WEBSOCKET_CONNECTIONS_TABLE,
+        'IndexName': CONNECTIONS_INDEX,
+        'KeyConditionExpression': Key('bucket').eq(f"{ACTIVE_BUCKET}#{shard}"),
+        'ProjectionExpression': 'connectionId',
+    }
+    while True:
+        # Resources aren't thread-safe, so shards query through the shared client.
+        response = dynamodb.meta.client.query(**query_kwargs)
+        connection_ids.extend(item['connectionId'] for item in response.get('Items', []))
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            return connection_ids
+        query_kwargs['ExclusiveStartKey'] = last_key
+
+# Shard queries run on one pool per Lambda container. Its threads start on the
+# first broadcast and are reused by every warm one after it.
+_shard_executor = None
+
+def get_connection_ids():
+    """Returns the ids of all active connections across every bucket shard."""
+    global _shard_executor
+    if _shard_executor is None:
+        _shard_executor = ThreadPoolExecutor(max_workers=ACTIVE_BUCKET_SHARDS)
+    shards = _shard_executor.map(get_shard_connection_ids, range(ACTIVE_BUCKET_SHARDS))
+    return [connection_id for shard in shards for connection_id in shard]
+
+def delete_connections(connection_ids, context=None):
     """
+    Deletes stale connections in BatchWriteItem requests of up to 25 keys,
+    retrying any UnprocessedItems with exponential backoff. When the Lambda
+    context is given, retries stop rather than sleep past the deadline.
+    """
+    for start in range(0, len(connection_ids), DELETE_BATCH_SIZE):
+        request_items = {
+            WEBSOCKET_CONNECTIONS_TABLE: [
+                {'DeleteRequest': {'Key': {'connectionId': connection_id}}}
+                for connection_id in connection_ids[start:start + DELETE_BATCH_SIZE]
+            ]
+        }
+        for attempt in range(DELETE_MAX_ATTEMPTS):
+            response = dynamodb.meta.client.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems')
+            if not request_items or attempt == DELETE_MAX_ATTEMPTS - 1:
+                break
+            delay = 0.05 * (2 ** attempt)
+            if context is not None and context.get_remaining_time_in_millis() < (delay * 1000) + DELETE_TIME_MARGIN_MS:
+                break
+            time.sleep(delay)
+        if request_items:
+            # Left for the next broadcast's GoneException or the row's TTL.
+            print(f"BROADCAST: Gave up deleting {len(request_items[WEBSOCKET_CONNECTIONS_TABLE])} stale connections.")
+
+def post_to_connection(gatewayapi, connection_id, message):
+    """Posts the message to one connection. Returns False if the connection is gone."""
     try:
-        # 1. Get the ApiGatewayManagementApi client
-        endpoint_url = f"https://{event['requestContext']['domainName']}/{event['requestContext']['stage']}"
-        gatewayapi = boto3.client("apigatewaymanagementapi", endpoint_url=endpoint_url)
+        gatewayapi.post_to_connection(ConnectionId=connection_id, Data=message)
+        print(f"BROADCAST: Message sent to {connection_id}.")
+    except gatewayapi.exceptions.GoneException:
+        print(f"BROADCAST: Connection {connection_id} is gone. Deleting.")
+        return False
+    except Exception as e:
+        print(f"BROADCAST: Failed to send to {connection_id}: {e}")
+    return True
+
+def post_to_connections(connection_ids, message, context=None):
+    """
+    Posts an already serialized message to the given connections and removes
+    the ones that are gone. When the Lambda context is given, batches that
+    cannot finish before the invocation times out are skipped.
+    Returns the ids of the connections that were skipped.
+    """
+    gatewayapi = get_gateway_client(WEBSOCKET_ENDPOINT)
+    stale_connection_ids = []
+    skipped_connection_ids = []
+
+    if len(connection_ids) <= SERIAL_BROADCAST_LIMIT:
+        # A handful of sends finish faster serially than it takes to start a pool.
+        for connection_id in connection_ids:
+            if not post_to_connection(gatewayapi, connection_id, message):
+                stale_connection_ids.append(connection_id)
+    else:
+        # Send the message to every connection in parallel, one batch at a time;
+        # the low-level client is thread-safe, so all workers share it.
+        executor = ThreadPoolExecutor(max_workers=BROADCAST_MAX_WORKERS)
+        timed_out = False
+        try:
+            for start in range(0, len(connection_ids), BROADCAST_BATCH_SIZE):
+                batch_timeout = None
+                if context is not None:
+                    remaining_ms = context.get_remaining_time_in_millis() - BROADCAST_TIME_RESERVE_MS
+                    if remaining_ms <= 0:
+                        timed_out = True
+                        skipped_connection_ids = connection_ids[start:]
+                        print(f"BROADCAST: Out of time, skipping {len(skipped_connection_ids)} connections.")
+                        break
+                    batch_timeout = remaining_ms / 1000
+
+                batch = connection_ids[start:start + BROADCAST_BATCH_SIZE]
+                futures = {
+                    executor.submit(post_to_connection, gatewayapi, connection_id, message): connection_id
+                    for connection_id in batch
+                }
+                done, not_done = wait(futures, timeout=batch_timeout)
+                # Only finished sends count; results of ones still running are
+                # never read, so a late GoneException can't miss the delete below.
+                stale_connection_ids.extend(futures[future] for future in done if not future.result())
+                if not_done:
+                    timed_out = True
+                    # Sends that already started can't be stopped and may still
+                    # be delivered, so only the ones cancelled here are skipped.
+                    cancelled_ids = [futures[future] for future in not_done if future.cancel()]
+                    skipped_connection_ids = cancelled_ids + connection_ids[start + len(batch):]
+                    in_flight = len(not_done) - len(cancelled_ids)
+                    print(f"BROADCAST: Out of time, skipping {len(skipped_connection_ids)} connections ({in_flight} sends still in flight).")
+                    break
+        finally:
+            # Don't block on sends that are still in flight once out of time.
+            executor.shutdown(wait=not timed_out)
+
+    # Remove connections that are gone from the table in batches
+    if stale_connection_ids:
+        delete_connections(stale_connection_ids, context)
 
-        # 2. Get all active connections from DynamoDB
-        response = connections_table.scan(ProjectionExpression='connectionId')
-        connection_ids = [item['connectionId'] for item in response.get('Items', [])]
+    return skipped_connection_ids
+
+def send_queue_batch(bodies):
+    """
+    Sends message bodies in one SendMessageBatch call, retrying entries that
+    failed on the SQS side with exponential backoff.
+    """
+    entries = [{'Id': str(index), 'MessageBody': body} for index, body in enumerate(bodies)]
+    for attempt in range(QUEUE_MAX_ATTEMPTS):
+        response = sqs.send_message_batch(QueueUrl=BROADCAST_QUEUE_URL, Entries=entries)
+        retry_ids = set()
+        for failure in response.get('Failed', []):
+            if failure.get('SenderFault'):
+                # The request itself is invalid; resending it won't help.
+                print(f"BROADCAST: Failed to queue connection group: {failure.get('Message')}")
+            else:
+                retry_ids.add(failure['Id'])
+        entries = [entry for entry in entries if entry['Id'] in retry_ids]
+        if not entries:
+            return
+        if attempt < QUEUE_MAX_ATTEMPTS - 1:
+            time.sleep(0.05 * (2 ** attempt))
+    print(f"BROADCAST: Gave up queueing {len(entries)} connection groups.")
+
+def send_queue_bodies(bodies):
+    """Sends a packed batch of message bodies, keeping failures to that batch."""
+    try:
+        if len(bodies) == 1:
+            # Too big to share a batch with anything else, or the last one left.
+            sqs.send_message(QueueUrl=BROADCAST_QUEUE_URL, MessageBody=bodies[0])
+        else:
+            send_queue_batch(bodies)
+    except Exception as e:
+        print(f"BROADCAST: Failed to queue {len(bodies)} connection groups: {e}")
+
+def enqueue_connection_groups(connection_ids, message):
+    """
+    Queues the message for the deliver Lambda, one SQS message per group of
+    CONNECTION_GROUP_SIZE connections. Messages are packed into batches of at
+    most QUEUE_BATCH_SIZE messages and QUEUE_BATCH_MAX_BYTES of bodies.
+    """
+    batch = []
+    batch_bytes = 0
+    for start in range(0, len(connection_ids), CONNECTION_GROUP_SIZE):
+        group = connection_ids[start:start + CONNECTION_GROUP_SIZE]
+        body = json.dumps({'message': message, 'connectionIds': group})
+        body_bytes = len(body.encode('utf-8'))
+        if batch and (len(batch) == QUEUE_BATCH_SIZE or batch_bytes + body_bytes > QUEUE_BATCH_MAX_BYTES):
+            send_queue_bodies(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(body)
+        batch_bytes += body_bytes
+    if batch:
+        send_queue_bodies(batch)
+
+def broadcast_message(payload, context=None):
+    """
+    Broadcasts a payload to all connected WebSocket clients.
+    Small broadcasts are posted directly; larger ones are split into
+    connection groups and handed to the deliver Lambda through SQS.
+    """
+    try:
+        # 1. Get all active connections from DynamoDB
+        connection_ids = get_connection_ids()
         print(f"BROADCAST: Found {len(connection_ids)} connections to broadcast to.")
 
-        # 3. Formatted message payload as a JSON string
-        message = json.dumps(payload)
+        # 2. Serialize the payload once as compact JSON, so it isn't
+        #    re-encoded for every connection
+        message = json.dumps(payload, separators=(',', ':'))
 
-        # 4. Send the message to each connection
-        for connection_id in connection_ids:
-            try:
-                gatewayapi.post_to_connection(
-                    ConnectionId=connection_id,
-                    Data=message
-                )
-                print(f"BROADCAST: Message sent to {connection_id}.")
-            except gatewayapi.exceptions.GoneException:
-                # 5. If the connection is gone, delete it from the table
-                print(f"BROADCAST: Connection {connection_id} is gone. Deleting.")
-                connections_table.delete_item(Key={'connectionId': connection_id})
-            except Exception as e:
-                print(f"BROADCAST: Failed to send to {connection_id}: {e}")
+        # 3. Post directly or fan out through the queue
+        if len(connection_ids) <= CONNECTION_GROUP_SIZE:
+            post_to_connections(connection_ids, message.encode('utf-8'), context)
+        else:
+            enqueue_connection_groups(connection_ids, message)
 
     except Exception as e:
         print(f"BROADCAST: Overall broadcast failed: {e}")
+
+def broadcast_handler(event, context):
+    """
+    Handles payloads published to the broadcast SNS topic.
+    Each SNS record is broadcast to all connected WebSocket clients.
+    """
+    for record in event.get('Records', []):
+        broadcast_message(json.loads(record['Sns']['Message']), context)
+
+def deliver_handler(event, context):
+    """
+    Handles connection groups queued by broadcast_message.
+    Each SQS record carries a serialized message and the connections to post it to.
+    Records that fail, or run out of time before every connection was posted
+    to, are returned as batchItemFailures so SQS redelivers them. A redelivered
+    group is posted to in full, so its clients may get the message twice.
+    """
+    batch_item_failures = []
+    for record in event.get('Records', []):
+        try:
+            body = json.loads(record['body'])
+            failed = bool(post_to_connections(body['connectionIds'], body['message'].encode('utf-8'), context))
+        except Exception as e:
+            print(f"BROADCAST: Delivering connection group failed: {e}")
+            failed = True
+        if failed:
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': batch_item_failures}
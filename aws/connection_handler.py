@@ -1,10 +1,23 @@
 import json
 import boto3
 import os
+import random
+import time
+from boto_config import BOTO_CONFIG
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = boto3.resource('dynamodb', config=BOTO_CONFIG)
 TABLE_NAME = os.environ.get('WEBSOCKET_CONNECTIONS_TABLE', 'mcm-alerts-websocket-connections')
 connections_table = dynamodb.Table(TABLE_NAME)
+# connect_handler assigns every new row to a random one of ACTIVE_BUCKET_SHARDS
+# buckets ("active#0" .. "active#15"). Broadcasts can then query the
+# bucket-index GSI instead of scanning the whole table, and new connections'
+# GSI writes are spread over 16 partitions instead of one. Must match
+# broadcast.py.
+ACTIVE_BUCKET = 'active'
+ACTIVE_BUCKET_SHARDS = 16
+# API Gateway closes WebSocket connections after 2 hours at most, so rows that
+# outlive that are orphans; DynamoDB TTL removes them via expires_at.
+CONNECTION_TTL_SECONDS = 7200
 
 def make_response(status_code, body):
     """Helper to create a standard API Gateway response."""
@@ -25,7 +38,9 @@ def connect_handler(event, context):
     try:
         connections_table.put_item(
             Item={
-                'connectionId': connection_id
+                'connectionId': connection_id,
+                'bucket': f"{ACTIVE_BUCKET}#{random.randrange(ACTIVE_BUCKET_SHARDS)}",
+                'expires_at': int(time.time()) + CONNECTION_TTL_SECONDS
             }
         )
         print(f"CONNECT: New connection {connection_id} stored.")